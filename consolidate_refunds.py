@@ -1,63 +1,241 @@
 """ 
 This script automates the process of updating transaction metadata in the Lunch Money app. It performs the following key functions:
 
-1. Retrieves all transactions from the Lunch Money API, fetching them month by month.
+1. Retrieves all transactions in the date range from the Lunch Money API, one page at a time.
 2. Constructs two dictionaries:
-   - A mapping of transaction amounts to their respective IDs.
-   - A mapping of transaction IDs to their detailed metadata.
-3. Identifies refund transactions and matches them with their corresponding charge transactions based on the transaction amount.
+   - A mapping of transaction amounts (in cents) to the IDs of every transaction with that amount.
+   - A mapping of transaction IDs to slim records holding only their payee, date and amount.
+3. Identifies refund transactions and matches each one with a distinct charge transaction of the same amount.
 4. For each matched pair of charge and refund, if the payee is the same, the script prepares new metadata. This metadata includes updating the payee name to indicate a refund and setting the date to the charge transaction's date.
 5. Executes PUT requests to the Lunch Money API to update the metadata of these transactions.
 
-The script uses Python's `requests` library for API interactions and `logging` for tracking its operations. API authentication is managed through a token loaded from a `.config` file.
+The script uses Python's `requests` library for API interactions and `logging` for tracking its operations. API authentication is managed through a token read from the `LUNCHMONEY_API_KEY` environment variable or, failing that, a `.config` file.
 
 Requirements:
 - Python 3
 - `requests` library
-- A `.config` file containing the API token
+- The API token, in the `LUNCHMONEY_API_KEY` environment variable or a `.config` file
 
 Usage:
-- Ensure the API token is set in the `.config` file under the key `LUNCHMONEY_API_KEY`.
+- Ensure the API token is set in the `LUNCHMONEY_API_KEY` environment variable or in the `.config` file under that key.
 - Run the script in a Python environment where `requests` is installed.
+- Pass `--start`/`--end` to skip the date prompts, `--yes` to skip the confirmation prompt,
+  or `--dry-run` to only preview the updates.
 """
 
 import requests
+import argparse
 import datetime
+import functools
 import logging
 import configparser
 import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import attrgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load API token from .config file
-config = configparser.ConfigParser()
-config.read('.config')
-TOKEN = config['DEFAULT']['LUNCHMONEY_API_KEY']  # Replace .config with your config file's path if necessary
-
 # Constants
 BASE_URL = "https://dev.lunchmoney.app/v1/transactions"
-HEADERS = {
-    'Authorization': f'Bearer {TOKEN}',
-    'Content-Type': 'application/json'
-}
-
-# Function to get transactions for a given month
-def get_transactions_for_month(start_date, end_date):
-    params = {'start_date': start_date, 'end_date': end_date}
+PAGE_SIZE = 500  # Transactions requested per page
+CACHE_DIR = 'data/cache'  # id/payee/date/amount of fetched pages; safe to delete
+MAX_UPDATE_WORKERS = 16
+RATE_LIMIT_RPS = 10  # Starting request rate; lowered whenever the API answers 429
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Only the fields the matching and update steps need; amount is in integer cents
+Tx = namedtuple('Tx', 'id payee date amount')
+REFUNDED_RE = re.compile(r'\(refunded\)$')  # Marker appended to payees of consolidated pairs
+
+# Load the API token on first use: LUNCHMONEY_API_KEY from the environment, else the .config file
+@functools.lru_cache(maxsize=1)
+def get_token():
+    token = os.environ.get('LUNCHMONEY_API_KEY')
+    if token:
+        return token
+    config = configparser.ConfigParser()
+    config.read('.config')
+    return config['DEFAULT']['LUNCHMONEY_API_KEY']  # Replace .config with your config file's path if necessary
+
+# Shared keep-alive session, created on first use, so every request reuses pooled connections.
+# All calls go to one host, so a single pool sized to the worker count caps the open sockets.
+# The lock makes sure concurrent first calls from worker threads build only one session.
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+def get_session():
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            session = requests.Session()
+            session.headers.update({
+                'Authorization': f'Bearer {get_token()}',
+                'Content-Type': 'application/json'
+            })
+            session.mount('https://', HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=MAX_UPDATE_WORKERS,
+                pool_block=True,
+                max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504]),
+            ))
+            SESSION = session
+        return SESSION
+
+# Function to check up front that an API token is configured
+def has_token():
     try:
-        response = requests.get(BASE_URL, headers=HEADERS, params=params)
-        response.raise_for_status()
-        return response.json().get('transactions', [])
-    except requests.RequestException as e:
-        logging.error(f"Error fetching transactions: {e}")
-        return []
+        get_token()
+        return True
+    except KeyError:
+        logging.error("No API token found: set LUNCHMONEY_API_KEY or add it to the .config file.")
+        return False
+
+class TokenBucket:
+    """Thread-safe rate limiter shared by every worker making API calls."""
+
+    def __init__(self, rps, min_rps=1):
+        self.rps = rps
+        self.min_rps = min_rps
+        self.tokens = rps
+        self.updated = time.monotonic()
+        self.resume_at = 0  # Deadline set by back_off; no request starts before it
+        self.generation = 0  # Bumped by back_off so sleeping workers re-queue behind the pause
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Reserve a token, going into debt if none are left, then sleep until its slot. If
+        # back_off starts a pause while we sleep, the reservation is dropped and taken again
+        # behind the new deadline, so nothing is sent during a Retry-After window.
+        generation = None
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if generation != self.generation:
+                    generation = self.generation
+                    start = max(now, self.resume_at)
+                    if start > self.updated:
+                        self.tokens = min(self.rps, self.tokens + (start - self.updated) * self.rps)
+                        self.updated = start
+                    self.tokens -= 1
+                    ready_at = start + (-self.tokens / self.rps if self.tokens < 0 else 0)
+                wait = ready_at - now
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def back_off(self, delay):
+        # Hold every worker until one shared deadline. Concurrent 429s extend the deadline
+        # rather than stacking, and the rate is cut by 20% only once per backoff window.
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.resume_at:
+                self.rps = max(self.min_rps, self.rps * 0.8)
+            self.resume_at = max(self.resume_at, now + delay)
+            # Start a fresh schedule at the deadline: outstanding reservations are retaken by
+            # their waiters, and no burst builds up during the pause
+            self.tokens = 1
+            self.updated = self.resume_at
+            self.generation += 1
+
+RATE_LIMITER = TokenBucket(RATE_LIMIT_RPS)
+
+# Function to send a rate-limited request, waiting out 429 responses
+def send_request(method, url, **kwargs):
+    for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+        RATE_LIMITER.acquire()
+        response = get_session().request(method, url, **kwargs)
+        if response.status_code != 429:
+            return response
+        try:
+            delay = float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            delay = 1.0
+        logging.warning(f"Rate limited by the API; backing off for {delay} seconds")
+        RATE_LIMITER.back_off(delay)
+    return response
+
+# Function to get one page of transactions as Tx records plus the API's has_more flag,
+# revalidating any cached copy with its ETag
+def get_transactions_page(start_date, end_date, offset):
+    params = {'start_date': start_date, 'end_date': end_date, 'limit': PAGE_SIZE, 'offset': offset}
+    cache_path = f'{CACHE_DIR}/{start_date}_{end_date}_{offset}.json'
+    etag_path = f'{cache_path}.etag'
+
+    # Only revalidate against a cached page that can actually be read back; a damaged
+    # entry is dropped so this request refetches the page instead of failing every run
+    headers = {}
+    cached_data = None
+    if os.path.exists(cache_path) and os.path.exists(etag_path):
+        try:
+            with open(cache_path, 'rb') as file:
+                cached_data = json.loads(file.read())
+            if not isinstance(cached_data.get('transactions'), list):
+                raise ValueError("missing transactions list")
+            with open(etag_path, 'r') as file:
+                headers['If-None-Match'] = file.read()
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warning(f"Discarding unreadable cache entry {cache_path}: {e}")
+            cached_data = None
+            for path in (cache_path, etag_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    response = send_request('GET', BASE_URL, params=params, headers=headers)
+    response.raise_for_status()
+    if response.status_code == 304:
+        data = cached_data
+    else:
+        # Parse the raw bytes directly; skips requests' text decoding step. Only the fields
+        # matching needs are kept, both in memory and in the on-disk cache.
+        data = json.loads(response.content)
+        data = {
+            'transactions': [{field: tx[field] for field in Tx._fields} for tx in data.get('transactions', [])],
+            'has_more': data.get('has_more'),
+        }
+        etag = response.headers.get('ETag')
+        if etag:
+            # Write to a temporary file and rename, so an interrupted run can't leave a
+            # truncated page behind its ETag
+            with open(f'{cache_path}.tmp', 'w') as file:
+                json.dump(data, file)
+            os.replace(f'{cache_path}.tmp', cache_path)
+            with open(etag_path, 'w') as file:
+                file.write(etag)
+
+    # Amounts become integer cents to avoid float-equality misses when matching
+    page = [Tx(tx['id'], tx['payee'], tx['date'], int(round(float(tx['amount']) * 100)))
+            for tx in data['transactions']]
+    # Fall back to a full-page check if the response doesn't carry has_more
+    has_more = data.get('has_more')
+    return page, has_more if has_more is not None else len(page) >= PAGE_SIZE
+
+# Function to get all transactions in a date range, one page at a time. Errors are raised
+# rather than returning a partial list, so nothing is matched or updated from incomplete data.
+def get_transactions(start_date, end_date):
+    transactions = []
+    offset = 0
+    while True:
+        page, has_more = get_transactions_page(start_date, end_date, offset)
+        transactions.extend(page)
+        if not has_more or not page:
+            return transactions
+        # Advance by what was returned, in case the server caps the page size below PAGE_SIZE
+        offset += len(page)
 
 # Function to update a transaction
 def update_transaction(transaction_id, metadata):
     url = f"{BASE_URL}/{transaction_id}"
     try:
-        response = requests.put(url, headers=HEADERS, json={"transaction": metadata})
+        response = send_request('PUT', url, json={"transaction": metadata})
         response.raise_for_status()
         return True
     except requests.RequestException as e:
@@ -68,74 +246,122 @@ def update_transaction(transaction_id, metadata):
 def revert_transaction(transaction_id, original_metadata):
     return update_transaction(transaction_id, original_metadata)
 
-# Function to save original metadata to a JSON file
+# Function to save original metadata to a line-delimited JSON file, one transaction per line
 def save_original_metadata_to_file(metadata, start_date, end_date):
-    filename=f'data/original_metadata_{start_date}_{end_date}.json'
+    filename=f'data/original_metadata_{start_date}_{end_date}.jsonl'
     with open(filename, 'w') as file:
-        json.dump(metadata, file, indent=4)
+        for tx_id, data in metadata.items():
+            file.write(json.dumps({tx_id: data}) + '\n')
     logging.info("Original metadata saved to file.")
 
 def gather_transactions(start_date, end_date):
-    amount_to_id = {}
+    amount_to_id = defaultdict(list)
     id_to_metadata = {}
-    current_end_date = end_date
-
-    while current_end_date > start_date:
-        current_start_date = current_end_date - datetime.timedelta(days=30)
-        if current_start_date < start_date:
-            current_start_date = start_date
-
-        transactions = get_transactions_for_month(current_start_date.isoformat(), current_end_date.isoformat())
-        for tx in transactions:
-            tx_id = tx['id']
-            amount = float(tx['amount'])
-            amount_to_id[amount] = tx_id
-            id_to_metadata[tx_id] = tx
 
-        current_end_date = current_start_date
+    for tx in get_transactions(start_date.isoformat(), end_date.isoformat()):
+        # Offset pages can overlap if rows shift between requests; keep the first copy only
+        if tx.id in id_to_metadata:
+            continue
+        amount_to_id[tx.amount].append(tx.id)
+        id_to_metadata[tx.id] = tx
 
     return amount_to_id, id_to_metadata
 
 def process_transactions(amount_to_id, id_to_metadata):
-    charge_to_refund = {}
-    tx_to_update_metadata = {}
-    negative_amount_to_id = {amount: tx_id for amount, tx_id in amount_to_id.items() if float(amount) < 0}
-    for amount, tx_id in negative_amount_to_id.items():
-        if -amount in amount_to_id:
-            charge_to_refund[amount_to_id[-amount]] = tx_id
-
-    for charge_id, refund_id in charge_to_refund.items():
-        charge = id_to_metadata[charge_id]
-        refund = id_to_metadata[refund_id]
-        if (charge['payee'] == refund['payee'] and 
-            charge['date'] != refund['date'] and 
-            'refunded' not in charge['payee']):
-            updated_metadata = {"payee": f"{charge['payee']} (refunded)", "date": charge['date']}
-            tx_to_update_metadata[charge_id] = updated_metadata
-            tx_to_update_metadata[refund_id] = updated_metadata
-    return tx_to_update_metadata
-
-def preview_and_confirm_updates(tx_to_update_metadata, id_to_metadata):
-    print("The following transactions will be updated:")
-    for tx_id, metadata in tx_to_update_metadata.items():
-        original_data = id_to_metadata[tx_id]
-        print(f"\nTransaction ID: {tx_id}")
-        print(f"Original Payee: {original_data['payee']}, Date: {original_data['date']}")
-        print(f"Updated Payee: {metadata['payee']}, Date: {metadata['date']}")
+    matches = []
+
+    # Walk the refunds (negative cents) and look up charges of the opposite amount
+    # in the same map. Each charge can be matched to at most one refund.
+    #
+    # Charges and refunds are sorted by date (then ID), so pairing never depends on API
+    # order. Refunds are taken oldest first, and each claims the unmatched same-payee
+    # charge with the latest date on or before its own. If every candidate is later than
+    # the refund, the earliest one (the closest in date) is used instead. A same-day pair
+    # is claimed but left unchanged, since there's nothing to consolidate.
+    matched_charge_ids = set()
+    by_date = attrgetter('date', 'id')
+    for amount, refund_ids in amount_to_id.items():
+        if amount >= 0 or -amount not in amount_to_id:
+            continue
+        charges = sorted((id_to_metadata[charge_id] for charge_id in amount_to_id[-amount]), key=by_date)
+        refunds = sorted((id_to_metadata[refund_id] for refund_id in refund_ids), key=by_date)
+        for refund in refunds:
+            candidates = [charge for charge in charges
+                          if charge.id not in matched_charge_ids and
+                          charge.payee == refund.payee and
+                          not REFUNDED_RE.search(charge.payee)]
+            if not candidates:
+                continue
+            earlier = [charge for charge in candidates if charge.date <= refund.date]
+            charge = earlier[-1] if earlier else candidates[0]
+            matched_charge_ids.add(charge.id)
+            if charge.date == refund.date:
+                continue
+            # One dict is shared by both sides of the pair. The v1 API has no bulk
+            # update endpoint, so each side is still sent as its own PUT.
+            updated_metadata = {"payee": f"{charge.payee} (refunded)", "date": charge.date}
+            matches.append((charge, refund, updated_metadata))
+    return matches
+
+def needs_update(tx, metadata):
+    return tx.payee != metadata['payee'] or tx.date != metadata['date']
+
+# Function to flatten (charge, refund, updated_metadata) matches into per-transaction updates,
+# leaving out any side that already has the updated payee and date
+def pending_updates(matches):
+    for charge, refund, updated_metadata in matches:
+        if needs_update(charge, updated_metadata):
+            yield charge, updated_metadata
+        if needs_update(refund, updated_metadata):
+            yield refund, updated_metadata
+
+def preview_updates(matches):
+    # Build the whole preview first and write it in one call instead of a print per line
+    lines = ["The following transactions will be updated:\n"]
+    for tx, metadata in pending_updates(matches):
+        lines.append(f"\nTransaction ID: {tx.id}\n")
+        lines.append(f"Original Payee: {tx.payee}, Date: {tx.date}\n")
+        lines.append(f"Updated Payee: {metadata['payee']}, Date: {metadata['date']}\n")
+    sys.stdout.writelines(lines)
+
+def preview_and_confirm_updates(matches, assume_yes=False):
+    preview_updates(matches)
+    if assume_yes:
+        return True
 
     confirm_update = input("\nDo you want to proceed with these updates? (yes/no): ")
     return confirm_update.lower() == 'yes'
 
-def perform_updates(tx_to_update_metadata, id_to_metadata, start_date, end_date):
-    original_metadata = {tx_id: id_to_metadata[tx_id] for tx_id in tx_to_update_metadata}
+def perform_updates(matches, start_date, end_date):
+    original_metadata = {tx.id: {'payee': tx.payee, 'date': tx.date} for tx, _ in pending_updates(matches)}
     save_original_metadata_to_file(original_metadata, start_date, end_date)
 
-    for tx_id, metadata in tx_to_update_metadata.items():
-        if update_transaction(tx_id, metadata):
-            logging.info(f"Transaction {tx_id} updated successfully.")
-        else:
-            logging.error(f"Failed to update transaction {tx_id}")
-            break  # Optional: Stop updating if any update fails
+    # Once any update fails, stop sending the ones that haven't started yet
+    failed = threading.Event()
+
+    def update_unless_failed(tx_id, metadata):
+        if failed.is_set():
+            return None
+        if not update_transaction(tx_id, metadata):
+            failed.set()
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=MAX_UPDATE_WORKERS) as executor:
+        futures = {executor.submit(update_unless_failed, tx.id, metadata): tx.id
+                   for tx, metadata in pending_updates(matches)}
+        for future in as_completed(futures):
+            tx_id = futures[future]
+            result = future.result()
+            if result:
+                logging.info(f"Transaction {tx_id} updated successfully.")
+            elif result is False:
+                logging.error(f"Failed to update transaction {tx_id}")
+            else:
+                logging.warning(f"Skipped transaction {tx_id} after an earlier failure")
+
+def parse_date(date_str):
+    return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
 
 def get_date_input(prompt, default=None):
     while True:
@@ -143,7 +369,7 @@ def get_date_input(prompt, default=None):
         if not date_str and default:
             return default
         try:
-            return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+            return parse_date(date_str)
         except ValueError:
             print("Invalid date format. Please use YYYY-MM-DD.")
 
@@ -153,20 +379,49 @@ def validate_date_range(start_date, end_date):
         return False
     return True
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Consolidate matching charge and refund transactions in Lunch Money.")
+    parser.add_argument('--start', type=parse_date, help="Start date (YYYY-MM-DD); prompted for if omitted")
+    parser.add_argument('--end', type=parse_date, help="End date (YYYY-MM-DD); defaults to today when --start is given")
+    parser.add_argument('--yes', action='store_true', help="Apply the updates without asking for confirmation")
+    parser.add_argument('--dry-run', action='store_true', help="Show the planned updates without applying them")
+    return parser.parse_args()
+
 def main():
-    print("Enter the date range for processing transactions:")
-    start_date = get_date_input("Start date (YYYY-MM-DD): ")
-    end_date = get_date_input("End date (YYYY-MM-DD), or press Enter for today's date: ", default=datetime.date.today())
+    args = parse_args()
+    if not has_token():
+        return
+
+    if args.start is None:
+        print("Enter the date range for processing transactions:")
+        start_date = get_date_input("Start date (YYYY-MM-DD): ")
+    else:
+        start_date = args.start
+    if args.end is not None:
+        end_date = args.end
+    elif args.start is not None:
+        end_date = datetime.date.today()
+    else:
+        end_date = get_date_input("End date (YYYY-MM-DD), or press Enter for today's date: ", default=datetime.date.today())
 
     if not validate_date_range(start_date, end_date):
         return
 
-    # Rest of the script remains the same
-    amount_to_id, id_to_metadata = gather_transactions(start_date, end_date)
-    tx_to_update_metadata = process_transactions(amount_to_id, id_to_metadata)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    try:
+        amount_to_id, id_to_metadata = gather_transactions(start_date, end_date)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logging.error(f"Error fetching transactions: {e}")
+        print("Could not fetch every transaction in the range; no updates were made.")
+        return
+    matches = process_transactions(amount_to_id, id_to_metadata)
 
-    if preview_and_confirm_updates(tx_to_update_metadata, id_to_metadata):
-        perform_updates(tx_to_update_metadata, id_to_metadata, start_date, end_date)
+    if args.dry_run:
+        preview_updates(matches)
+        print("\nDry run: no transactions were updated.")
+    elif preview_and_confirm_updates(matches, assume_yes=args.yes):
+        perform_updates(matches, start_date, end_date)
     else:
         print("Update process aborted.")
 
@@ -1,58 +1,79 @@
-import requests
+import argparse
+import glob
 import logging
 import json
-import configparser
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Reuse the rate-limited session so a rollback shares its request budget and 429 handling
+from consolidate_refunds import update_transaction, has_token, MAX_UPDATE_WORKERS
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load API token from .config file
-config = configparser.ConfigParser()
-config.read('.config')
-TOKEN = config['DEFAULT']['LUNCHMONEY_API_KEY']  # Replace .config with your config file's path if necessary
-
-# Constants
-BASE_URL = "https://dev.lunchmoney.app/v1/transactions"
-HEADERS = {
-    'Authorization': f'Bearer {TOKEN}',
-    'Content-Type': 'application/json'
-}
-
-# Function to update a transaction
-def update_transaction(transaction_id, metadata):
-    url = f"{BASE_URL}/{transaction_id}"
-    try:
-        response = requests.put(url, headers=HEADERS, json={"transaction": metadata})
-        response.raise_for_status()
-        return True
-    except requests.RequestException as e:
-        logging.error(f"Error updating transaction {transaction_id}: {e}")
-        return False
-
-# Function to load original metadata from a JSON file
-def load_original_metadata_from_file(filename='data/original_metadata.json'):
+# Function to load original metadata from a backup file. Backups are line-delimited JSON,
+# but indented .json backups written by earlier versions are still accepted.
+def load_original_metadata_from_file(filename):
     try:
         with open(filename, 'r') as file:
-            return json.load(file)
+            try:
+                original_metadata = {}
+                for line in file:
+                    if line.strip():
+                        original_metadata.update(json.loads(line))
+                return original_metadata
+            except ValueError:
+                file.seek(0)
+                return json.load(file)
     except FileNotFoundError:
-        logging.error("JSON file with original metadata not found.")
+        logging.error(f"Original metadata file {filename} not found.")
+        return {}
+    except ValueError as e:
+        logging.error(f"Original metadata file {filename} is not valid JSON or JSONL: {e}")
         return {}
 
-def rollback_transactions():
-    # Load original metadata from the JSON file
-    original_metadata = load_original_metadata_from_file()
+# Function to find the most recently written backup in data/
+def find_latest_metadata_file():
+    backups = glob.glob('data/original_metadata_*.jsonl') + glob.glob('data/original_metadata_*.json')
+    return max(backups, key=os.path.getmtime) if backups else None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Revert transactions to the metadata saved by consolidate_refunds.py.")
+    parser.add_argument('filename', nargs='?',
+                        help="Backup file to restore from; defaults to the newest data/original_metadata_* file")
+    return parser.parse_args()
+
+def rollback_transactions(filename=None):
+    if not has_token():
+        return
+
+    filename = filename or find_latest_metadata_file()
+    if filename is None:
+        logging.error("Rollback aborted: No original metadata file found in data/.")
+        return
+    logging.info(f"Restoring original metadata from {filename}")
+
+    # Load original metadata from the backup file
+    original_metadata = load_original_metadata_from_file(filename)
 
     # Check if original metadata is loaded
     if not original_metadata:
         logging.error("Rollback aborted: No original metadata available.")
         return
 
-    # Rollback transactions to their original state
-    for tx_id, original_data in original_metadata.items():
-        if update_transaction(tx_id, original_data):
-            logging.info(f"Transaction {tx_id} reverted to original state successfully.")
-        else:
-            logging.error(f"Failed to revert transaction {tx_id}")
+    # Rollback transactions to their original state concurrently
+    failed_tx_ids = []
+    with ThreadPoolExecutor(max_workers=MAX_UPDATE_WORKERS) as executor:
+        futures = {executor.submit(update_transaction, tx_id, original_data): tx_id
+                   for tx_id, original_data in original_metadata.items()}
+        for future in as_completed(futures):
+            if not future.result():
+                failed_tx_ids.append(futures[future])
+
+    if failed_tx_ids:
+        logging.error(f"Failed to revert {len(failed_tx_ids)} of {len(original_metadata)} transactions: {failed_tx_ids}")
+    else:
+        logging.info(f"All {len(original_metadata)} transactions reverted to original state successfully.")
 
 if __name__ == "__main__":
-    rollback_transactions()
+    rollback_transactions(parse_args().filename)